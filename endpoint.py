@@ -1,14 +1,25 @@
 from fastapi import FastAPI, HTTPException, Request
 from datetime import datetime
-from google.cloud import bigquery
+from google.cloud import bigquery_storage_v1
+from google.cloud.bigquery_storage_v1 import exceptions as bqstorage_exceptions
+from google.cloud.bigquery_storage_v1 import types, writer
+from google.api_core import exceptions as api_exceptions
+from google.protobuf import descriptor_pb2
 import json
+import orjson
+import re
 import logging
-import requests
-import whisper
-import tempfile
+import httpx
+import ctranslate2
+from faster_whisper import BatchedInferencePipeline, WhisperModel
+import asyncio
+import concurrent.futures
+import cachetools
+import hashlib
 import os
-import subprocess
-import magic
+import time
+import numpy as np
+import event_pb2
 
 # Configure logging
 logging.basicConfig(
@@ -19,152 +30,319 @@ logger = logging.getLogger(__name__)
 
 app = FastAPI()
 
-# BigQuery client
-client = bigquery.Client()
+# BigQuery Storage Write API client
+write_client = bigquery_storage_v1.BigQueryWriteClient()
 
-# Load Whisper model
-logger.info("Loading Whisper model...")
-model = whisper.load_model("base")
+# Shared HTTP client so audio downloads reuse pooled keep-alive connections
+http_client = httpx.AsyncClient(
+    http2=True,
+    follow_redirects=True,
+    headers={
+        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
+        'Accept': '*/*'
+    },
+    limits=httpx.Limits(max_keepalive_connections=100),
+    timeout=30,
+)
+
+# Load Whisper model once; its CTranslate2 workers share the same weights and
+# each runs one request's transcription, so up to WHISPER_WORKERS requests
+# are transcribed in parallel (see _transcribe_slots)
+WHISPER_WORKERS = 2
+# Use the GPU when one is visible: int8 weights with float16 activations
+if ctranslate2.get_cuda_device_count() > 0:
+    WHISPER_DEVICE, WHISPER_COMPUTE_TYPE = "cuda", "int8_float16"
+else:
+    WHISPER_DEVICE, WHISPER_COMPUTE_TYPE = "cpu", "int8"
+logger.info(f"Loading Whisper model on {WHISPER_DEVICE} ({WHISPER_COMPUTE_TYPE})...")
+model = WhisperModel(
+    "base",
+    device=WHISPER_DEVICE,
+    compute_type=WHISPER_COMPUTE_TYPE,
+    cpu_threads=max(1, (os.cpu_count() or 1) // WHISPER_WORKERS),
+    num_workers=WHISPER_WORKERS,
+)
+batched_model = BatchedInferencePipeline(model=model)
 logger.info("Whisper model loaded successfully")
 
+# Transcriptions of recently seen audio, keyed by the SHA-256 of the
+# downloaded bytes (and by URL + strong ETag when the server sends one),
+# so webhook retries skip the download and/or the model
+transcription_cache = cachetools.LRUCache(maxsize=4096)
+
+# BatchedInferencePipeline only batches within one file: it runs the VAD
+# chunks of a single recording TRANSCRIBE_BATCH_SIZE at a time
+TRANSCRIBE_BATCH_SIZE = 8
+# One in-flight transcription per CTranslate2 worker
+_transcribe_slots = asyncio.Semaphore(WHISPER_WORKERS)
+
+# Digit runs that may not fit in 64 bits (int64 max has 19 digits)
+_WIDE_INT = re.compile(rb'\d{19,}')
+
 # BigQuery table details
 PROJECT_ID = "zapy-306602"
 DATASET_ID = "gtms"
 TABLE_ID = "events"
 
-def inspect_file(file_path):
-    """Inspect the file using ffprobe"""
-    try:
-        cmd = ['ffprobe', '-v', 'error', '-show_format', '-show_streams', file_path]
-        result = subprocess.run(cmd, capture_output=True, text=True)
-        logger.info(f"File inspection result:\n{result.stdout}")
-        return result.stdout
-    except Exception as e:
-        logger.error(f"Error inspecting file: {e}")
-        return None
+# BigQuery insert batching
+INSERT_BATCH_SIZE = 500  # max rows per insert request
+INSERT_FLUSH_INTERVAL = 1.0  # seconds
+INSERT_MAX_BUFFERED = 50000  # rows; new events are refused beyond this
+APPEND_TIMEOUT = 30  # seconds to wait for an append response
+APPEND_ATTEMPTS = 2  # per chunk and flush
+_row_buffer: list[event_pb2.Event] = []
+_buffer_lock = asyncio.Lock()
+_flush_requested = asyncio.Event()
+_flusher_stop = asyncio.Event()
+
+# Write stream and row schema are resolved once, not on every (re)open
+_WRITE_STREAM = write_client.write_stream_path(PROJECT_ID, DATASET_ID, TABLE_ID, "_default")
+_event_descriptor = descriptor_pb2.DescriptorProto()
+event_pb2.Event.DESCRIPTOR.CopyToProto(_event_descriptor)
+_WRITER_SCHEMA = types.ProtoSchema(proto_descriptor=_event_descriptor)
+
+def open_append_stream() -> writer.AppendRowsStream:
+    """Open an append stream on the table's default write stream"""
+    request_template = types.AppendRowsRequest(
+        write_stream=_WRITE_STREAM,
+        proto_rows=types.AppendRowsRequest.ProtoData(writer_schema=_WRITER_SCHEMA),
+    )
+    return writer.AppendRowsStream(write_client, request_template)
+
+append_stream = open_append_stream()
+
+def reopen_append_stream():
+    """Replace the append stream with a new one (blocking, close() joins the consumer thread)"""
+    global append_stream
+    append_stream.close()
+    append_stream = open_append_stream()
+
+# Append failures after which the rows were not written and can be sent again
+RETRYABLE_APPEND_ERRORS = (
+    bqstorage_exceptions.StreamClosedError,
+    api_exceptions.ServiceUnavailable,
+    api_exceptions.Aborted,
+    api_exceptions.ResourceExhausted,
+)
+
+def log_dropped_rows(rows: list[event_pb2.Event]):
+    """Write rows that will not be retried to the log so they can be recovered"""
+    for row in rows:
+        logger.error(f"Dropped row: {row.created_at} {row.event_name} {row.body}")
+
+def append_rows(rows: list[event_pb2.Event]):
+    """Append serialized rows to the default stream and wait for the result (blocking)"""
+    proto_data = types.AppendRowsRequest.ProtoData()
+    proto_data.rows = types.ProtoRows(serialized_rows=[row.SerializeToString() for row in rows])
+    return append_stream.send(types.AppendRowsRequest(proto_rows=proto_data)).result(timeout=APPEND_TIMEOUT)
+
+def transcribe_audio(audio: np.ndarray) -> str:
+    """Run the batched Whisper pipeline on 16 kHz mono samples (blocking)"""
+    segments, info = batched_model.transcribe(
+        audio, batch_size=TRANSCRIBE_BATCH_SIZE, beam_size=1, vad_filter=True
+    )
+    # segments is a lazy generator, decoding happens while joining
+    return "".join(s.text for s in segments).strip()
+
+async def flush_rows():
+    """Append buffered rows to BigQuery in chunks of INSERT_BATCH_SIZE"""
+    global _row_buffer
+    async with _buffer_lock:
+        rows, _row_buffer = _row_buffer, []
+    
+    if not rows:
+        return
+    
+    loop = asyncio.get_running_loop()
+    failed = []
+    for chunk in (rows[i:i + INSERT_BATCH_SIZE] for i in range(0, len(rows), INSERT_BATCH_SIZE)):
+        for attempt in range(1, APPEND_ATTEMPTS + 1):
+            try:
+                await loop.run_in_executor(None, append_rows, chunk)
+            except RETRYABLE_APPEND_ERRORS as e:
+                # Nothing was written: either send() found the stream closed
+                # before any data went out, or the server failed the request
+                logger.warning(f"Error appending {len(chunk)} rows (attempt {attempt}): {e}")
+                await loop.run_in_executor(None, reopen_append_stream)
+            except concurrent.futures.TimeoutError:
+                # The request went out and may have been committed, so it is
+                # not retried; a retry could write the rows twice
+                logger.error(f"Append of {len(chunk)} rows timed out, they may not have been written")
+                log_dropped_rows(chunk)
+                await loop.run_in_executor(None, reopen_append_stream)
+                break
+            except Exception as e:
+                # Invalid rows, a missing table or missing permissions will not
+                # succeed on retry; keep the rows in the log and drop them
+                logger.error(f"Dropping {len(chunk)} rows after append error: {e}")
+                log_dropped_rows(chunk)
+                break
+            else:
+                logger.info(f"Appended {len(chunk)} rows to BigQuery")
+                break
+        else:
+            logger.error(f"Could not append {len(chunk)} rows in {APPEND_ATTEMPTS} attempts")
+            failed.extend(chunk)
+    
+    if failed:
+        # Put the rows back in front of newer events for the next flush
+        logger.warning(f"Re-queueing {len(failed)} rows after failed appends")
+        async with _buffer_lock:
+            _row_buffer[:0] = failed
+
+async def row_flusher():
+    """Flush the row buffer every INSERT_FLUSH_INTERVAL or when it fills up"""
+    while not _flusher_stop.is_set():
+        try:
+            await asyncio.wait_for(_flush_requested.wait(), INSERT_FLUSH_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        _flush_requested.clear()
+        await flush_rows()
+
+@app.on_event("startup")
+async def start_row_flusher():
+    app.state.row_flusher = asyncio.create_task(row_flusher())
+
+@app.on_event("shutdown")
+async def stop_row_flusher():
+    # Let an in-progress flush finish instead of cancelling it mid-append
+    _flusher_stop.set()
+    _flush_requested.set()
+    await app.state.row_flusher
+    await flush_rows()
+    if _row_buffer:
+        logger.error(f"Dropping {len(_row_buffer)} unsent rows on shutdown")
+    append_stream.close()
+
+@app.on_event("shutdown")
+async def close_http_client():
+    await http_client.aclose()
 
 async def download_and_transcribe(url: str) -> str:
-    temp_oga = None
-    wav_path = None
+    process = None
     
     try:
-        # Download the file with headers
+        # Download the file through the shared client
         logger.info(f"Downloading audio from URL: {url}")
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
-            'Accept': '*/*'
-        }
         
         # Stream the download to check for content
-        response = requests.get(url, headers=headers, stream=True)
-        response.raise_for_status()
-        
-        # Log response headers
-        logger.info("Response headers:")
-        for key, value in response.headers.items():
-            logger.info(f"{key}: {value}")
-        
-        # Check Content-Type
-        content_type = response.headers.get('Content-Type', '')
-        logger.info(f"Content-Type from response: {content_type}")
-        
-        # Create temporary OGA file in a more accessible location
-        temp_dir = os.path.join(os.path.expanduser("~"), "Downloads", "audio_temp")
-        os.makedirs(temp_dir, exist_ok=True)
-        
-        temp_oga_path = os.path.join(temp_dir, f"audio_{datetime.now().strftime('%Y%m%d_%H%M%S')}.oga")
-        logger.info(f"Saving audio to: {temp_oga_path}")
-        
-        # Download in chunks and show progress
-        downloaded_size = 0
-        content_length = response.headers.get('Content-Length')
-        
-        with open(temp_oga_path, 'wb') as temp_oga:
-            for chunk in response.iter_content(chunk_size=8192):
-                if chunk:
-                    temp_oga.write(chunk)
-                    downloaded_size += len(chunk)
-                    if content_length:
-                        progress = (downloaded_size / int(content_length)) * 100
-                        logger.info(f"Download progress: {progress:.1f}%")
+        async with http_client.stream("GET", url) as response:
+            response.raise_for_status()
+            
+            # Log response headers
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Response headers:")
+                for key, value in response.headers.items():
+                    logger.debug(f"{key}: {value}")
+            
+            # Check Content-Type
+            content_type = response.headers.get('Content-Type', '')
+            logger.info(f"Content-Type from response: {content_type}")
+            
+            # A strong ETag identifies the content without downloading it
+            etag = response.headers.get('ETag')
+            etag_key = (url, etag) if etag and not etag.startswith('W/') else None
+            if etag_key in transcription_cache:
+                logger.info("Using cached transcription (ETag match)")
+                return transcription_cache[etag_key]
+            
+            # Decode while downloading: the body is piped into ffmpeg and
+            # 16 kHz mono PCM is read back from its stdout
+            process = await asyncio.create_subprocess_exec(
+                'ffmpeg', '-hide_banner', '-loglevel', 'error',
+                '-i', 'pipe:0',
+                '-f', 's16le', '-acodec', 'pcm_s16le', '-ar', '16000', '-ac', '1',
+                'pipe:1',
+                stdin=asyncio.subprocess.PIPE,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+            )
+            
+            # Download in chunks and show progress at most once per second
+            downloaded_size = 0
+            content_length = int(response.headers.get('Content-Length') or 0)
+            next_log = time.monotonic() + 1.0
+            digest = hashlib.sha256()
             
-            temp_oga.flush()
-            os.fsync(temp_oga.fileno())
+            async def feed_ffmpeg():
+                nonlocal downloaded_size, next_log
+                try:
+                    async for chunk in response.aiter_bytes(1 << 16):
+                        if not chunk:
+                            continue
+                        if downloaded_size == 0:
+                            # Log the first few bytes for debugging
+                            if logger.isEnabledFor(logging.DEBUG):
+                                logger.debug(f"File header (hex): {chunk[:16].hex()}")
+                            # WhatsApp voice notes are Ogg/Opus
+                            if not chunk.startswith(b'OggS'):
+                                raise ValueError(f"Unsupported audio format, expected Ogg (header: {chunk[:4].hex()})")
+                        digest.update(chunk)
+                        process.stdin.write(chunk)
+                        await process.stdin.drain()
+                        downloaded_size += len(chunk)
+                        if content_length and time.monotonic() >= next_log:
+                            next_log = time.monotonic() + 1.0
+                            progress = (downloaded_size / content_length) * 100
+                            logger.info(f"Download progress: {progress:.1f}%")
+                except (BrokenPipeError, ConnectionResetError):
+                    # ffmpeg exited early, its return code is checked below
+                    pass
+                finally:
+                    process.stdin.close()
+            
+            _, pcm, stderr = await asyncio.gather(
+                feed_ffmpeg(), process.stdout.read(), process.stderr.read()
+            )
+        
+        await process.wait()
         
-        # Verify downloaded file
-        file_size = os.path.getsize(temp_oga_path)
-        logger.info(f"Downloaded file size: {file_size} bytes")
+        # Verify downloaded data
+        logger.info(f"Downloaded file size: {downloaded_size} bytes")
         
-        if file_size == 0:
+        if downloaded_size == 0:
             raise ValueError("Downloaded file is empty")
         
-        # Get MIME type and verify it's an audio file
-        mime_type = magic.from_file(temp_oga_path, mime=True)
-        logger.info(f"Detected MIME type: {mime_type}")
-        
-        # Read and log the first few bytes for debugging
-        with open(temp_oga_path, 'rb') as f:
-            header = f.read(16)
-            logger.info(f"File header (hex): {header.hex()}")
-        
-        # Create temporary WAV file
-        wav_path = os.path.join(temp_dir, f"audio_{datetime.now().strftime('%Y%m%d_%H%M%S')}.wav")
-        logger.info(f"WAV file will be saved to: {wav_path}")
-        
-        # Try different ffmpeg approaches
-        conversion_commands = [
-            # Try as OGG
-            ['ffmpeg', '-y', '-f', 'ogg', '-i', temp_oga_path, '-acodec', 'pcm_s16le', '-ar', '16000', '-ac', '1', wav_path],
-            # Try as raw audio
-            ['ffmpeg', '-y', '-f', 'audio', '-i', temp_oga_path, '-acodec', 'pcm_s16le', '-ar', '16000', '-ac', '1', wav_path],
-            # Try without format specification
-            ['ffmpeg', '-y', '-i', temp_oga_path, '-acodec', 'pcm_s16le', '-ar', '16000', '-ac', '1', wav_path]
-        ]
-        
-        success = False
-        for cmd in conversion_commands:
-            try:
-                logger.info(f"Trying conversion with command: {' '.join(cmd)}")
-                result = subprocess.run(cmd, capture_output=True, text=True)
-                if result.returncode == 0:
-                    success = True
-                    break
-                else:
-                    logger.error(f"Conversion attempt failed: {result.stderr}")
-            except Exception as e:
-                logger.error(f"Error during conversion attempt: {str(e)}")
+        if process.returncode != 0:
+            logger.error(f"Conversion failed: {stderr.decode(errors='replace').strip()}")
+            raise RuntimeError(f"Conversion failed with exit code {process.returncode}")
         
-        if not success:
-            raise RuntimeError("All conversion attempts failed")
+        # Verify the converted audio
+        logger.info(f"Converted PCM size: {len(pcm)} bytes")
         
-        # Verify the converted file
-        wav_size = os.path.getsize(wav_path)
-        logger.info(f"Converted WAV file size: {wav_size} bytes")
+        if not pcm:
+            raise ValueError("Converted audio is empty")
         
-        if wav_size == 0:
-            raise ValueError("Converted WAV file is empty")
+        content_key = digest.digest()
+        if content_key in transcription_cache:
+            logger.info("Using cached transcription (content hash match)")
+            transcription = transcription_cache[content_key]
+            if etag_key:
+                transcription_cache[etag_key] = transcription
+            return transcription
         
-        # Inspect the WAV file
-        logger.info("Inspecting converted WAV file:")
-        inspect_file(wav_path)
+        # Scale in place so only one float32 buffer is allocated before the
+        # log-mel features are computed from it
+        audio = np.frombuffer(pcm, np.int16).astype(np.float32)
+        audio *= 1 / 32768.0
         
         # Transcribe the audio
         logger.info("Starting transcription...")
-        result = model.transcribe(wav_path)
-        transcription = result["text"].strip()
+        async with _transcribe_slots:
+            transcription = await asyncio.get_running_loop().run_in_executor(None, transcribe_audio, audio)
         
         logger.info("=" * 40)
         logger.info(f"Transcription: {transcription}")
         logger.info("=" * 40)
         
-        # Keep the files for inspection
-        logger.info(f"Audio files saved at:")
-        logger.info(f"OGA: {temp_oga_path}")
-        logger.info(f"WAV: {wav_path}")
+        transcription_cache[content_key] = transcription
+        if etag_key:
+            transcription_cache[etag_key] = transcription
         
         return transcription
         
-    except requests.exceptions.RequestException as e:
+    except httpx.HTTPError as e:
         logger.error(f"Error downloading file: {e}")
         raise HTTPException(status_code=500, detail=f"Download error: {str(e)}")
     except ValueError as e:
@@ -173,13 +351,42 @@ async def download_and_transcribe(url: str) -> str:
     except Exception as e:
         logger.error(f"Error in download_and_transcribe: {e}")
         raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        if process is not None and process.returncode is None:
+            process.kill()
+            await process.wait()
+
+def parse_body(raw_body: bytes) -> tuple[dict, bool]:
+    """Parse a request body with orjson, or with the stdlib when orjson could lose data
+
+    orjson rejects NaN/Infinity and turns integers wider than 64 bits into
+    floats, so bodies that may hold either go through json instead. Returns
+    the body and whether orjson parsed it (and can serialize it back).
+    """
+    if not _WIDE_INT.search(raw_body):
+        try:
+            return orjson.loads(raw_body), True
+        except orjson.JSONDecodeError:
+            pass
+    return json.loads(raw_body), False
+
+def refuse_if_buffer_full():
+    """Answer 503 while BigQuery is failing and the buffer is full so the sender retries"""
+    if len(_row_buffer) >= INSERT_MAX_BUFFERED:
+        logger.error(f"Row buffer full ({len(_row_buffer)} rows), refusing event")
+        raise HTTPException(status_code=503, detail="Event buffer full, retry later")
 
 @app.post("/events")
 async def create_event(request: Request):
     try:
         # Get raw JSON
-        body = await request.json()
-        logger.info(f"Received request body: {json.dumps(body, indent=2)}")
+        raw_body = await request.body()
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"Received request body: {raw_body.decode(errors='replace')}")
+        body, parsed_with_orjson = parse_body(raw_body)
+        
+        # Refuse before spending a download and a transcription slot on it
+        refuse_if_buffer_full()
         
         # Check for audio attachments and transcribe
         transcription = None
@@ -200,21 +407,19 @@ async def create_event(request: Request):
             # Continue with the request even if transcription fails
         
         # Prepare data for BigQuery
-        row = {
-            "created_at": datetime.utcnow().isoformat(),
-            "event_name": body.get("event_type", "unknown"),
-            "body": json.dumps(body)
-        }
-        
-        # Get table reference
-        table_ref = f"{PROJECT_ID}.{DATASET_ID}.{TABLE_ID}"
-        
-        # Insert data into BigQuery
-        errors = client.insert_rows_json(table_ref, [row])
+        row = event_pb2.Event(
+            created_at=datetime.utcnow().isoformat(),
+            event_name=body.get("event_type", "unknown"),
+            body=orjson.dumps(body).decode() if parsed_with_orjson else json.dumps(body)
+        )
         
-        if errors:
-            logger.error(f"BigQuery errors: {errors}")
-            raise HTTPException(status_code=500, detail=f"Error inserting rows: {errors}")
+        # Queue the row for the next batched insert; the buffer may have
+        # filled up while this event was being transcribed
+        async with _buffer_lock:
+            refuse_if_buffer_full()
+            _row_buffer.append(row)
+            if len(_row_buffer) >= INSERT_BATCH_SIZE:
+                _flush_requested.set()
         
         response_data = {"status": "success", "message": "Event saved successfully"}
         if transcription:
@@ -222,6 +427,8 @@ async def create_event(request: Request):
             
         return response_data
     
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))